@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
-import gzip
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
 import json
 import logging
 import logging.config
@@ -9,10 +13,27 @@ import os
 import re
 import shutil
 import tempfile
+import threading
 import time
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import requests
+import urllib3
+from boto3.s3.transfer import TransferConfig
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # ISA-L provides a drop-in gzip module with a much faster inflate and CRC32
+    from isal import igzip as gzip
+except ImportError:
+    try:
+        # zlib-ng's gzip module also uses SIMD inflate and CLMUL based CRC32
+        from zlib_ng import gzip_ng as gzip
+    except ImportError:
+        import gzip
 
 
 LOGGING_CONFIG = {
@@ -45,126 +66,526 @@ LOGGING_CONFIG = {
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger('app')
 
+# Buffer size used when copying the RHCOS image between streams and files
+COPY_BUFFER_SIZE = 1024 * 1024
 
-class OpenShiftRelease(object):
-    def __init__(self, version, s3_bucket):
-        self.version = version
-        self.s3_bucket = s3_bucket
+# Upload the RHCOS image to S3 as concurrent multipart uploads
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=32 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
 
-        self._data = None
-        self._rhcos_filename = None
-        self._rhcos_path = None
-        self._rhcos_url = None
-        self._rhcos_version = None
+# Streamed uploads can't re-read the source, so s3transfer holds every part
+# that hasn't been sent yet in memory. Keep that to 4 x 16 MiB per upload,
+# which together with the parallel download buffers comes to about 160 MiB
+# for each of the MAX_WORKERS versions being processed.
+S3_STREAM_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True,
+)
+S3_STREAM_TRANSFER_CONFIG.max_in_memory_upload_chunks = 4
 
-    @property
-    def data(self):
-        if not self._data:
-            r = requests.get('http://mirror.openshift.com/pub/openshift-v4/clients/ocp/{}/release.txt'.format(self.version))
-            self._data = r.text
+# RHCOS version listed in an OpenShift release.txt
+MACHINE_OS_RE = re.compile(r'machine-os ([\d\.\-]+)', re.MULTILINE)
 
-        return self._data
+# OpenShift versions that are GA releases, e.g. 4.7.7 but not 4.7.0-rc.1
+RELEASE_VERSION_RE = re.compile(r'^\d+\.\d+\.\d+$')
 
-    @property
-    def rhcos_version(self):
-        if not self._rhcos_version:
-            # Find the RHCOS version for the release
-            m = re.search(r'machine-os ([\d\.\-]+)', self.data, re.MULTILINE)
-            if not m:
-                logger.info('Unable to find RHCOS version for {}'.format(self.version))
-                return None
+# Number of OpenShift versions to process at the same time
+MAX_WORKERS = 4
 
-            self._rhcos_version = m.group(1)
-            logger.info('RHCOS version {}'.format(self._rhcos_version))
+# Download the RHCOS image as byte ranges of this size, this many at a time
+RANGE_CHUNK_SIZE = 12 * 1024 * 1024
+RANGE_WORKERS = 8
 
-        return self._rhcos_version
+# Connect and read timeouts for HTTP requests, so a stalled connection is
+# retried or resumed instead of hanging forever
+HTTP_TIMEOUT = (10, 60)
 
-    @property
-    def rhcos_url(self):
-        # return 'http://mirror.openshift.com/pub/openshift-v4/dependencies/rhcos/4.7/4.7.7/rhcos-4.7.7-x86_64-aws.x86_64.vmdk.gz'
+# Shared by all HTTP requests so connections to the same host are reused,
+# transient connection failures and server errors are retried
+SESSION = requests.Session()
+for prefix in ('http://', 'https://'):
+    SESSION.mount(prefix, HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=MAX_WORKERS * RANGE_WORKERS,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+        ),
+    ))
 
-        if not self._rhcos_url:
-            base_url = 'https://releases-art-rhcos.svc.ci.openshift.org/art/storage/releases'
-            self._rhcos_url = '/'.join([
-                base_url,
-                'rhcos-{}'.format('.'.join(self.version.split('.')[0:2])),
-                self.rhcos_version,
-                'x86_64',
-                '{}.gz'.format(self.rhcos_filename),
-            ])
+_rhcos_locks = {}
+_rhcos_locks_lock = threading.Lock()
 
-        return self._rhcos_url
 
-    @property
-    def rhcos_filename(self):
-        if not self._rhcos_filename:
-            self._rhcos_filename = 'rhcos-{}-aws.x86_64.vmdk'.format(self.rhcos_version)
+def rhcos_lock(rhcos_version):
+    """Get the lock guarding the import of an RHCOS version"""
+    with _rhcos_locks_lock:
+        return _rhcos_locks.setdefault(rhcos_version, threading.Lock())
 
-        return self._rhcos_filename
-    @property
-    def rhcos_path(self):
-        if not self._rhcos_path:
-            self._rhcos_path = os.path.join(tempfile.gettempdir(), self.rhcos_filename)
 
-        return self._rhcos_path
+# Clients are created from their own session because boto3's default session
+# isn't safe to create clients from in multiple threads. The clients
+# themselves are safe to share.
+@functools.lru_cache(maxsize=None)
+def ec2_client():
+    return boto3.session.Session().client('ec2')
 
-    def download_rhcos(self):
-        if os.path.exists(self.rhcos_path):
-            logger.info('Skipping download because {} already exists'.format(self.rhcos_path))
-            return
 
+@functools.lru_cache(maxsize=None)
+def s3_client():
+    # Enough connections for every version worker to upload at full concurrency
+    config = botocore.config.Config(max_pool_connections=MAX_WORKERS * S3_TRANSFER_CONFIG.max_concurrency)
+
+    return boto3.session.Session().client('s3', config=config)
+
+
+@functools.lru_cache(maxsize=None)
+def release_txt(version):
+    """Fetch the release.txt of an OpenShift version"""
+    r = SESSION.get('http://mirror.openshift.com/pub/openshift-v4/clients/ocp/{}/release.txt'.format(version), timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+
+    return r.text
+
+
+class ResumableDownload(io.RawIOBase):
+    """Read-only file object over an HTTP download
+
+    If the connection drops part way through, the download is picked up
+    again from the last byte read. That uses a Range request, or skips over
+    the bytes already read if the server sends the whole file again.
+    """
+
+    def __init__(self, url, length=None, response=None, attempts=5):
+        super().__init__()
+
+        self.url = url
+        self.attempts = attempts
+
+        self.length = length
+        self.position = 0
+
+        # Carry on from a response that was already opened for the download
+        self._response = None
+        if response is not None:
+            self._attach(response)
+
+    def _connect(self):
+        headers = {'Accept-Encoding': 'identity'}
+        if self.position:
+            headers['Range'] = 'bytes={}-'.format(self.position)
+
+        r = SESSION.get(self.url, headers=headers, stream=True, timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+
+        self._attach(r)
+
+        if self.position and r.status_code != 206:
+            logger.info('Server ignored range request for {}, skipping the first {} bytes'.format(self.url, self.position))
+
+            remaining = self.position
+            while remaining:
+                data = r.raw.read(min(remaining, COPY_BUFFER_SIZE))
+                if not data:
+                    raise urllib3.exceptions.ProtocolError('Connection closed before reaching byte {}'.format(self.position))
+                remaining -= len(data)
+
+    def _attach(self, r):
+        # Hand over the bytes exactly as they are served
+        r.raw.decode_content = False
+
+        if self.length is None and 'Content-Length' in r.headers:
+            self.length = int(r.headers['Content-Length'])
+
+        self._response = r
+
+    def read(self, size=-1):
+        attempt = 0
+        while True:
+            try:
+                if self._response is None:
+                    self._connect()
+
+                data = self._response.raw.read(size)
+                if not data and size != 0 and self.length is not None and self.position < self.length:
+                    raise urllib3.exceptions.ProtocolError('Connection closed after {} of {} bytes'.format(self.position, self.length))
+            except (requests.ConnectionError, requests.Timeout, urllib3.exceptions.HTTPError) as e:
+                self._disconnect()
+
+                attempt += 1
+                if attempt >= self.attempts:
+                    raise
+
+                logger.warning('Download of {} interrupted at {} bytes, resuming: {}'.format(self.url, self.position, e))
+                continue
+
+            self.position += len(data)
+            return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Buffered gzip readers such as isal's read through readinto()
+        data = self.read(len(b))
+        b[:len(data)] = data
+
+        return len(data)
+
+    def _disconnect(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def close(self):
+        self._disconnect()
+        super().close()
+
+
+class ParallelDownload(io.RawIOBase):
+    """Read-only file object over an HTTP download fetched in byte ranges
+
+    Ranges are downloaded concurrently ahead of the reader and handed out in
+    order, so only about `workers` ranges are held in memory at a time.
+    Nothing is requested until the first read, so a caller can still back
+    out after looking at `length`.
+    """
+
+    def __init__(self, url, length, chunk_size=RANGE_CHUNK_SIZE, workers=RANGE_WORKERS, attempts=5):
+        super().__init__()
+
+        self.url = url
+        self.length = length
+        self.attempts = attempts
+        self.workers = workers
+
+        self.position = 0
+
+        self._ranges = collections.deque(
+            (start, min(start + chunk_size, length) - 1)
+            for start in range(0, length, chunk_size)
+        )
+        self._pending = collections.deque()
+        self._buffer = memoryview(b'')
+        self._offset = 0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # Set on close to stop fetches that are already running
+        self._stopped = threading.Event()
+
+    def _schedule(self):
+        while self._ranges and len(self._pending) < self.workers:
+            start, end = self._ranges.popleft()
+            self._pending.append(self._executor.submit(self._fetch, start, end))
+
+    def _fetch(self, start, end):
+        attempt = 0
+        while True:
+            try:
+                headers = {
+                    'Accept-Encoding': 'identity',
+                    'Range': 'bytes={}-{}'.format(start, end),
+                }
+                with SESSION.get(self.url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+                    r.raise_for_status()
+
+                    # open_download only gets here once the server served a
+                    # range, so treat a full response as a transient fault
+                    if r.status_code != 206:
+                        raise urllib3.exceptions.ProtocolError('Server ignored range request for bytes {}-{}'.format(start, end))
+
+                    # Read in large blocks rather than through r.content, which
+                    # pulls the body in 10 KiB pieces
+                    data = bytearray()
+                    for chunk in r.iter_content(chunk_size=COPY_BUFFER_SIZE):
+                        if self._stopped.is_set():
+                            return None
+                        data += chunk
+
+                if len(data) != end - start + 1:
+                    raise urllib3.exceptions.ProtocolError('Got {} bytes for range {}-{}'.format(len(data), start, end))
+
+                return data
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError) as e:
+                attempt += 1
+                if attempt >= self.attempts:
+                    raise
+
+                if self._stopped.is_set():
+                    return None
+
+                logger.warning('Download of {} bytes {}-{} interrupted, retrying: {}'.format(self.url, start, end, e))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # read() comes from RawIOBase on top of this, buffered gzip readers
+        # such as isal's call it directly
+        view = memoryview(b).cast('B')
+
+        # Start the first ranges on the first read
+        self._schedule()
+
+        size = 0
+        while size < len(view):
+            if self._offset == len(self._buffer):
+                if not self._pending:
+                    break
+
+                self._buffer = memoryview(self._pending.popleft().result())
+                self._offset = 0
+                self._schedule()
+
+            n = min(len(view) - size, len(self._buffer) - self._offset)
+            view[size:size + n] = self._buffer[self._offset:self._offset + n]
+            size += n
+            self._offset += n
+
+        self.position += size
+        return size
+
+    def close(self):
+        self._stopped.set()
+        self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        super().close()
+
+
+def open_download(url):
+    """Open an HTTP download as a file object
+
+    The download starts with a request for its first byte. A server that
+    answers with that range is downloaded over several connections in
+    parallel. One that sends the whole file instead is streamed from that
+    response over a single connection.
+    """
+    r = SESSION.get(url, headers={'Accept-Encoding': 'identity', 'Range': 'bytes=0-0'}, stream=True, timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+
+    if r.status_code == 206:
+        r.close()
+
+        # Content-Range: bytes 0-0/<length>
+        length = r.headers.get('Content-Range', '').rpartition('/')[2]
+        if length.isdigit():
+            return ParallelDownload(r.url, int(length))
+
+        # Open the download right away so its Content-Length is known before
+        # anything is read from it
+        logger.info('Server did not report the size of {}, downloading it over a single connection'.format(url))
+        r = SESSION.get(url, headers={'Accept-Encoding': 'identity'}, stream=True, timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+
+    else:
+        logger.info('Server does not support range requests, downloading {} over a single connection'.format(url))
+
+    return ResumableDownload(url, response=r)
+
+
+class NonSeekableReader(object):
+    """Expose only the read side of a file object
+
+    GzipFile claims to be seekable, which makes s3transfer seek to the end
+    to size the upload, unpacking the whole stream just to throw it away
+    and then failing to rewind. Hiding that makes it stream the upload.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def seekable(self):
+        return False
+
+
+def find_rhcos_snapshots(ec2):
+    """Map RHCOS versions to the IDs of the snapshots imported for them"""
+    snapshots = {}
+
+    paginator = ec2.get_paginator('describe_snapshots')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'tag-key',
+                'Values': ['rhcos_version'],
+            }
+        ],
+        OwnerIds=['self'],
+    )
+    for page in pages:
+        for snapshot in page['Snapshots']:
+            for tag in snapshot.get('Tags', []):
+                if tag['Key'] == 'rhcos_version':
+                    snapshots.setdefault(tag['Value'], snapshot['SnapshotId'])
+
+    return snapshots
+
+
+def find_rhcos_images(ec2):
+    """Map RHCOS image names to their image IDs"""
+    existing_images = ec2.describe_images(
+        Filters=[
+            {
+                'Name': 'name',
+                'Values': ['rhcos-*'],
+            }
+        ],
+        Owners=['self'],
+    )
+
+    images = {}
+    for image in existing_images['Images']:
+        images.setdefault(image['Name'], image['ImageId'])
+
+    return images
+
+
+class OpenShiftRelease(object):
+    def __init__(self, version, s3_bucket, snapshots=None, images=None):
+        self.version = version
+        self.s3_bucket = s3_bucket
+
+        # Existing snapshots and images from find_rhcos_snapshots and
+        # find_rhcos_images, looked up on first use if not given. These can be
+        # shared between releases, new ones are added as they are created.
+        self.snapshots = snapshots
+        self.images = images
+
+        self._resolve()
+
+    @property
+    def data(self):
+        return release_txt(self.version)
+
+    def _resolve(self):
+        # Find the RHCOS version for the release
+        m = MACHINE_OS_RE.search(self.data)
+        if not m:
+            raise RuntimeError('Unable to find RHCOS version for {}'.format(self.version))
+
+        self.rhcos_version = m.group(1)
+        logger.info('RHCOS version {}'.format(self.rhcos_version))
+
+        self.rhcos_filename = 'rhcos-{}-aws.x86_64.vmdk'.format(self.rhcos_version)
+        self.rhcos_path = os.path.join(tempfile.gettempdir(), self.rhcos_filename)
+
+        # self.rhcos_url = 'http://mirror.openshift.com/pub/openshift-v4/dependencies/rhcos/4.7/4.7.7/rhcos-4.7.7-x86_64-aws.x86_64.vmdk.gz'
+        base_url = 'https://releases-art-rhcos.svc.ci.openshift.org/art/storage/releases'
+        self.rhcos_url = '/'.join([
+            base_url,
+            'rhcos-{}'.format('.'.join(self.version.split('.')[0:2])),
+            self.rhcos_version,
+            'x86_64',
+            '{}.gz'.format(self.rhcos_filename),
+        ])
+
+    @contextlib.contextmanager
+    def open_rhcos(self):
+        """Stream the unpacked RHCOS image straight from the mirror"""
         logger.info('Downloading {}'.format(self.rhcos_url))
-        r = requests.get(self.rhcos_url)
+        with open_download(self.rhcos_url) as r:
+            # Bail out before downloading anything if the server already
+            # reports a file that is too small, the readers don't request the
+            # body until the first read
+            if r.length is not None:
+                self._check_rhcos_size(r.length)
 
-        rhcos_gzip_path = '{}.gz'.format(self.rhcos_path)
+            with gzip.GzipFile(fileobj=r, mode='rb') as f:
+                yield f
 
-        with open(rhcos_gzip_path, 'wb') as f:
-            logger.info('Saving {}'.format(rhcos_gzip_path))
-            f.write(r.content)
+            self._check_rhcos_size(r.position)
 
-        rhcos_size = os.path.getsize(rhcos_gzip_path)
+    def _check_rhcos_size(self, rhcos_size):
         rhcos_size_mb = rhcos_size / (1024 * 1024)
         if rhcos_size_mb < 100:
             raise RuntimeError('RHCOS file size too small {} bytes ({} MB)'.format(rhcos_size, rhcos_size_mb))
 
-        logger.info('Unpacking {}'.format(rhcos_gzip_path))
-        with gzip.open(rhcos_gzip_path, 'rb') as f_in:
-            with open(self.rhcos_path, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        os.remove(rhcos_gzip_path)
+    def download_rhcos(self):
+        """Save the unpacked RHCOS image to rhcos_path
+
+        The import streams the image straight into S3 and doesn't call this,
+        it is for keeping a local copy. upload_rhcos uploads that copy
+        instead of downloading the image again.
+        """
+        if os.path.exists(self.rhcos_path):
+            logger.info('Skipping download because {} already exists'.format(self.rhcos_path))
+            return
+
+        # Unpack next to the final path and only move it into place once it is
+        # complete, so a crashed run never leaves a partial image behind that
+        # the check above would take for a finished one
+        rhcos_part_path = '{}.part'.format(self.rhcos_path)
+
+        # Unpack while downloading so the .gz never has to touch the disk
+        try:
+            with self.open_rhcos() as f_in:
+                logger.info('Unpacking to {}'.format(rhcos_part_path))
+                with open(rhcos_part_path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, length=COPY_BUFFER_SIZE)
+        except Exception:
+            if os.path.exists(rhcos_part_path):
+                os.remove(rhcos_part_path)
+            raise
+
+        os.replace(rhcos_part_path, self.rhcos_path)
 
     def upload_rhcos(self):
-        s3 = boto3.client('s3')
+        s3 = s3_client()
 
-        if s3.list_objects_v2(Bucket=self.s3_bucket, Prefix=self.rhcos_filename).get('KeyCount', 0) > 0:
+        try:
+            s3.head_object(Bucket=self.s3_bucket, Key=self.rhcos_filename)
             logger.info('Skipping upload because s3://{}/{} already exists'.format(self.s3_bucket, self.rhcos_filename))
             return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                raise
 
-        self.download_rhcos()
-
-        with open(self.rhcos_path, 'rb') as f:
+        # Reuse an image saved by download_rhcos instead of fetching it again,
+        # its atomic rename means anything at rhcos_path is a complete image
+        if os.path.exists(self.rhcos_path):
             logger.info('Uploading {} to S3'.format(self.rhcos_path))
-            s3.upload_fileobj(f, self.s3_bucket, self.rhcos_filename)
-        os.remove(self.rhcos_path)
+            s3.upload_file(self.rhcos_path, self.s3_bucket, self.rhcos_filename, Config=S3_TRANSFER_CONFIG)
+            os.remove(self.rhcos_path)
+            return
+
+        # Pipe the image from the mirror through gzip into S3 without staging
+        # the unpacked VMDK on disk
+        try:
+            with self.open_rhcos() as f:
+                logger.info('Uploading to s3://{}/{}'.format(self.s3_bucket, self.rhcos_filename))
+                s3.upload_fileobj(NonSeekableReader(f), self.s3_bucket, self.rhcos_filename, Config=S3_STREAM_TRANSFER_CONFIG)
+        except Exception:
+            # Don't leave a bad image behind for the existence check above,
+            # without letting a failed cleanup hide the original error
+            try:
+                s3.delete_object(Bucket=self.s3_bucket, Key=self.rhcos_filename)
+            except Exception as e:
+                logger.error('Unable to remove s3://{}/{}: {}'.format(self.s3_bucket, self.rhcos_filename, e))
+            raise
 
     def import_snapshot(self):
         self.upload_rhcos()
 
         description = 'rhcos-{}'.format(self.rhcos_version)
 
-        ec2 = boto3.client('ec2')
+        ec2 = ec2_client()
 
-        existing_snapshots = ec2.describe_snapshots(
-            Filters=[
-                {
-                    'Name': 'tag:rhcos_version',
-                    'Values': [self.rhcos_version],
-                }
-            ],
-            OwnerIds=['self'],
-        )
-        if len(existing_snapshots['Snapshots']) > 0:
-            snapshot_id = existing_snapshots['Snapshots'][0]['SnapshotId']
+        if self.snapshots is None:
+            self.snapshots = find_rhcos_snapshots(ec2)
+
+        if self.rhcos_version in self.snapshots:
+            snapshot_id = self.snapshots[self.rhcos_version]
             logger.info('Skipping snapshot creation because {} already exists'.format(snapshot_id))
             return snapshot_id
 
@@ -181,7 +602,10 @@ class OpenShiftRelease(object):
             },
         )['ImportTaskId']
 
-        time_elapsed = 0
+        # Poll with exponential backoff, starting fast so quick imports are
+        # picked up right away and easing off for the long ones
+        delay = 1.0
+        deadline = time.monotonic() + 60 * 5
         while True:
             logger.info('Checking status of snapshot import task {}'.format(import_task_id))
             snapshot_task = ec2.describe_import_snapshot_tasks(
@@ -203,40 +627,36 @@ class OpenShiftRelease(object):
                         }
                     ],
                 )
+                self.snapshots[self.rhcos_version] = snapshot_id
 
                 return snapshot_id
 
-            logger.info('Snapshot import task {} not complete, waiting 10 seconds to try again'.format(import_task_id))
+            if time.monotonic() > deadline:
+                raise RuntimeError('More than 5 minutes have passed and snapshot import task {} has not completed'.format(import_task_id))
 
-            time_elapsed += 10
-            time.sleep(10)
+            logger.info('Snapshot import task {} not complete, waiting {:.0f} seconds to try again'.format(import_task_id, delay))
 
-            if time_elapsed > 60 * 5:
-                raise RuntimeError('More than 5 minutes have passed and snapshot import task {} has not completed'.format(import_task_id))
+            time.sleep(delay)
+            delay = min(delay * 1.5, 30)
 
     def register_image(self):
         snapshot_id = self.import_snapshot()
 
-        ec2 = boto3.client('ec2')
+        ec2 = ec2_client()
 
-        existing_images = ec2.describe_images(
-            Filters=[
-                {
-                    'Name': 'name',
-                    'Values': ['rhcos-{}'.format(self.rhcos_version)],
-                }
-            ],
-            Owners=['self'],
-        )
-        if len(existing_images['Images']) > 0:
-            image_id = existing_images['Images'][0]['ImageId']
+        if self.images is None:
+            self.images = find_rhcos_images(ec2)
+
+        image_name = 'rhcos-{}'.format(self.rhcos_version)
+        if image_name in self.images:
+            image_id = self.images[image_name]
             logger.info('Skipping image creation because {} already exists'.format(image_id))
             return image_id
 
         logger.info('Registering image from snapshot {}'.format(snapshot_id))
 
         image_id = ec2.register_image(
-            Name='rhcos-{}'.format(self.rhcos_version),
+            Name=image_name,
             Description='OpenShift 4 {}'.format(self.rhcos_version),
             Architecture='x86_64',
             BlockDeviceMappings=[
@@ -260,6 +680,7 @@ class OpenShiftRelease(object):
         )['ImageId']
 
         logger.info('Created image {}'.format(image_id))
+        self.images[image_name] = image_id
 
         logger.info('Making image {} public'.format(image_id))
         ec2.modify_image_attribute(
@@ -276,40 +697,63 @@ class OpenShiftRelease(object):
         return image_id
 
 
+def process_version(version, snapshots=None, images=None):
+    logger.info('Processing OpenShift {}'.format(version))
+
+    try:
+        release = OpenShiftRelease(version, 'io-rhdt-govcloud-vmimport', snapshots=snapshots, images=images)
+
+        # Several OpenShift releases can ship the same RHCOS version, only one
+        # of them should download and import it while the others wait and
+        # then skip over the existing image
+        with rhcos_lock(release.rhcos_version):
+            release.register_image()
+    except Exception as e:
+        logger.error(e)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('versions_to_upload', nargs='+')
     known_args, extra_args = parser.parse_known_args()
 
     openshift_versions = []
+    seen_versions = set()
     versions_to_upload = known_args.versions_to_upload
+    minor_versions = set(versions_to_upload)
 
 
     for i in versions_to_upload:
-        r = requests.get(
+        r = SESSION.get(
             'https://api.openshift.com/api/upgrades_info/v1/graph',
             params={
                 'channel': 'stable-{}'.format(i),
             },
             headers={
                 'Accept': 'application/json',
-            }
+            },
+            timeout=HTTP_TIMEOUT,
         )
 
         data=r.json()
         for node in data['nodes']:
             version = node['version']
-            if '.'.join(version.split('.')[0:2]) in versions_to_upload and re.search(r'^\d+\.\d+\.\d+$', version):
-                if version not in openshift_versions:
-                    openshift_versions.append(version)
+            if version in seen_versions:
+                continue
 
-    openshift_versions.sort(reverse=True, key=lambda s: list(map(int, s.split('.'))))
+            if '.'.join(version.split('.')[0:2]) in minor_versions and RELEASE_VERSION_RE.search(version):
+                seen_versions.add(version)
+                openshift_versions.append(version)
 
-    for v in openshift_versions:
-        logger.info('Processing OpenShift {}'. format(v))
+    openshift_versions.sort(reverse=True, key=lambda s: tuple(map(int, s.split('.'))))
 
-        try:
-            release = OpenShiftRelease(v, 'io-rhdt-govcloud-vmimport')
-            release.register_image()
-        except Exception as e:
-            logger.error(e)
+    # Look up what has already been imported once for all versions
+    ec2 = ec2_client()
+    snapshots = find_rhcos_snapshots(ec2)
+    images = find_rhcos_images(ec2)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(
+            functools.partial(process_version, snapshots=snapshots, images=images),
+            openshift_versions,
+        ))
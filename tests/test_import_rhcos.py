@@ -0,0 +1,439 @@
+import gzip
+import importlib
+import io
+import os
+import random
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import boto3
+import requests
+import urllib3
+from botocore.stub import ANY, Stubber
+
+import import_rhcos
+
+
+RELEASE_TXT = 'machine-os 47.83.202104250838-0 Red Hat Enterprise Linux CoreOS\n'
+
+# Every gzip implementation import_rhcos may pick that is installed here
+GZIP_MODULES = [gzip]
+for name in ('isal.igzip', 'zlib_ng.gzip_ng'):
+    try:
+        GZIP_MODULES.append(importlib.import_module(name))
+    except ImportError:
+        pass
+
+
+def make_image(size=2 * 1024 * 1024):
+    image = random.Random(0).randbytes(size)
+    return image, gzip.compress(image, compresslevel=1)
+
+
+class FlakyBody(object):
+    """urllib3 response body that drops the connection after some bytes"""
+
+    def __init__(self, data, drop_after=None):
+        self.decode_content = True
+        self._data = io.BytesIO(data)
+        self._drop_after = drop_after
+
+    def read(self, size=-1):
+        if self._drop_after is None:
+            return self._data.read(size)
+
+        remaining = self._drop_after - self._data.tell()
+        if remaining <= 0:
+            raise urllib3.exceptions.ProtocolError('Connection dropped')
+
+        if size < 0:
+            size = remaining
+
+        return self._data.read(min(size, remaining))
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200, drop_after=None, headers=None):
+        self.status_code = status_code
+        self.headers = {'Content-Length': str(len(data))}
+        self.headers.update(headers or {})
+        self.raw = FlakyBody(data, drop_after)
+        self.url = 'https://mirror.example.com/rhcos.vmdk.gz'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class FakeDownload(io.RawIOBase):
+    """Non-seekable stand-in for the readers returned by open_download"""
+
+    def __init__(self, data):
+        super().__init__()
+        self.length = None
+        self._data = io.BytesIO(data)
+
+    @property
+    def position(self):
+        return self._data.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._data.readinto(b)
+
+
+def make_release():
+    with mock.patch.object(import_rhcos, 'release_txt', return_value=RELEASE_TXT):
+        return import_rhcos.OpenShiftRelease('4.7.7', 'bucket')
+
+
+def make_s3_client():
+    return boto3.session.Session().client(
+        's3',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing',
+    )
+
+
+class OpenRHCOSTest(unittest.TestCase):
+    def test_unpacks_with_every_gzip_backend(self):
+        image, blob = make_image()
+        release = make_release()
+
+        for module in GZIP_MODULES:
+            with self.subTest(gzip=module.__name__):
+                download = import_rhcos.ResumableDownload('https://mirror.example.com/rhcos.vmdk.gz', response=FakeResponse(blob))
+                with mock.patch.object(import_rhcos, 'gzip', module), \
+                        mock.patch.object(import_rhcos, 'open_download', return_value=download), \
+                        mock.patch.object(import_rhcos.OpenShiftRelease, '_check_rhcos_size') as check_rhcos_size:
+                    with release.open_rhcos() as f:
+                        self.assertEqual(f.read(), image)
+
+                check_rhcos_size.assert_called_with(len(blob))
+
+
+class DownloadRHCOSTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+        with mock.patch('tempfile.gettempdir', return_value=self.tmpdir.name):
+            self.release = make_release()
+
+    def test_failed_download_leaves_nothing_behind(self):
+        _, blob = make_image()
+        # Cut the download off half way through
+        download = import_rhcos.ResumableDownload('https://mirror.example.com/rhcos.vmdk.gz', response=FakeResponse(blob[:len(blob) // 2]), attempts=1)
+
+        with mock.patch.object(import_rhcos, 'open_download', return_value=download):
+            with self.assertRaises(Exception):
+                self.release.download_rhcos()
+
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_download_is_moved_into_place(self):
+        image, blob = make_image()
+        download = import_rhcos.ResumableDownload('https://mirror.example.com/rhcos.vmdk.gz', response=FakeResponse(blob))
+
+        with mock.patch.object(import_rhcos, 'open_download', return_value=download), \
+                mock.patch.object(import_rhcos.OpenShiftRelease, '_check_rhcos_size'):
+            self.release.download_rhcos()
+
+        self.assertEqual(os.listdir(self.tmpdir.name), [self.release.rhcos_filename])
+        with open(self.release.rhcos_path, 'rb') as f:
+            self.assertEqual(f.read(), image)
+
+
+class UploadRHCOSTest(unittest.TestCase):
+    def setUp(self):
+        self.release = make_release()
+        self.s3 = make_s3_client()
+        self.stubber = Stubber(self.s3)
+
+        patchers = [
+            mock.patch.object(import_rhcos, 's3_client', return_value=self.s3),
+            # The test image is far smaller than a real one
+            mock.patch.object(import_rhcos.OpenShiftRelease, '_check_rhcos_size'),
+            mock.patch('os.path.exists', return_value=False),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+
+    def test_streamed_multipart_upload(self):
+        # Enough for two parts of the streamed upload
+        image = random.Random(0).randbytes(20 * 1024 * 1024)
+        download = FakeDownload(gzip.compress(image, compresslevel=1))
+
+        parts = {}
+
+        def record_part(params, **kwargs):
+            parts[params['PartNumber']] = params['Body'].read()
+            params['Body'].seek(0)
+
+        self.s3.meta.events.register('before-parameter-build.s3.UploadPart', record_part)
+
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'upload-id'}, {
+            'Bucket': 'bucket',
+            'Key': self.release.rhcos_filename,
+            'ChecksumAlgorithm': ANY,
+        })
+        self.stubber.add_response('upload_part', {'ETag': '"1"'}, {
+            'Bucket': 'bucket',
+            'Key': self.release.rhcos_filename,
+            'UploadId': 'upload-id',
+            'PartNumber': ANY,
+            'Body': ANY,
+            'ChecksumAlgorithm': ANY,
+        })
+        self.stubber.add_response('upload_part', {'ETag': '"2"'}, {
+            'Bucket': 'bucket',
+            'Key': self.release.rhcos_filename,
+            'UploadId': 'upload-id',
+            'PartNumber': ANY,
+            'Body': ANY,
+            'ChecksumAlgorithm': ANY,
+        })
+        self.stubber.add_response('complete_multipart_upload', {}, {
+            'Bucket': 'bucket',
+            'Key': self.release.rhcos_filename,
+            'UploadId': 'upload-id',
+            'MultipartUpload': ANY,
+        })
+
+        with self.stubber, mock.patch.object(import_rhcos, 'open_download', return_value=download):
+            self.release.upload_rhcos()
+
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(b''.join(parts[n] for n in sorted(parts)), image)
+
+    def test_failed_cleanup_keeps_upload_error(self):
+        self.stubber.add_client_error('delete_object', service_error_code='AccessDenied', http_status_code=403)
+
+        with self.stubber, mock.patch.object(import_rhcos, 'open_download', side_effect=RuntimeError('mirror down')):
+            with self.assertRaisesRegex(RuntimeError, 'mirror down'):
+                self.release.upload_rhcos()
+
+        self.stubber.assert_no_pending_responses()
+
+
+class ResumableDownloadTest(unittest.TestCase):
+    def test_resumes_after_dropped_connections(self):
+        image, blob = make_image()
+        requested = []
+
+        def get(url, headers=None, **kwargs):
+            headers = headers or {}
+            requested.append(headers.get('Range'))
+            if 'Range' not in headers:
+                return FakeResponse(blob, drop_after=256 * 1024)
+
+            start = int(headers['Range'][len('bytes='):-1])
+            # Drop the first resumed connection as well
+            drop_after = 256 * 1024 if len(requested) == 2 else None
+            return FakeResponse(blob[start:], status_code=206, drop_after=drop_after)
+
+        for module in GZIP_MODULES:
+            with self.subTest(gzip=module.__name__):
+                requested.clear()
+                with mock.patch.object(import_rhcos.SESSION, 'get', side_effect=get):
+                    with import_rhcos.ResumableDownload('https://mirror.example.com/rhcos.vmdk.gz') as r:
+                        with module.GzipFile(fileobj=r, mode='rb') as f:
+                            self.assertEqual(f.read(), image)
+
+                        self.assertEqual(r.position, len(blob))
+
+                self.assertEqual(len(requested), 3)
+                self.assertIsNone(requested[0])
+
+    def test_resumes_without_range_support(self):
+        image, blob = make_image()
+        calls = []
+
+        def get(url, headers=None, timeout=None, **kwargs):
+            calls.append(timeout)
+            if len(calls) == 2:
+                raise requests.exceptions.ReadTimeout('Read timed out')
+
+            # Ignore the Range header and drop the first connection
+            drop_after = 256 * 1024 if len(calls) == 1 else None
+            return FakeResponse(blob, drop_after=drop_after)
+
+        for module in GZIP_MODULES:
+            with self.subTest(gzip=module.__name__):
+                calls.clear()
+                with mock.patch.object(import_rhcos.SESSION, 'get', side_effect=get):
+                    with import_rhcos.ResumableDownload('https://mirror.example.com/rhcos.vmdk.gz') as r:
+                        with module.GzipFile(fileobj=r, mode='rb') as f:
+                            self.assertEqual(f.read(), image)
+
+                self.assertEqual(calls, [import_rhcos.HTTP_TIMEOUT] * 3)
+
+
+class ParallelDownloadTest(unittest.TestCase):
+    def test_reassembles_ranges_in_order(self):
+        image, blob = make_image()
+        dropped = set()
+
+        def get(url, headers=None, **kwargs):
+            start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+
+            # Drop every other range the first time it is requested
+            drop_after = None
+            if (start // (100 * 1024)) % 2 and start not in dropped:
+                dropped.add(start)
+                drop_after = 1024
+
+            return FakeResponse(blob[start:end + 1], status_code=206, drop_after=drop_after)
+
+        for module in GZIP_MODULES:
+            with self.subTest(gzip=module.__name__):
+                dropped.clear()
+                with mock.patch.object(import_rhcos.SESSION, 'get', side_effect=get):
+                    with import_rhcos.ParallelDownload(url='https://mirror.example.com/rhcos.vmdk.gz', length=len(blob), chunk_size=100 * 1024, workers=3) as r:
+                        with module.GzipFile(fileobj=r, mode='rb') as f:
+                            self.assertEqual(f.read(), image)
+
+                        self.assertEqual(r.position, len(blob))
+
+                self.assertTrue(dropped)
+
+    def test_close_stops_running_fetches(self):
+        chunk_size = 4 * 1024 * 1024
+        blob = random.Random(0).randbytes(4 * chunk_size)
+
+        reading = threading.Semaphore(0)
+        gate = threading.Event()
+        served = {}
+
+        def get(url, headers=None, **kwargs):
+            start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+            r = FakeResponse(blob[start:end + 1], status_code=206)
+            if start == 0:
+                return r
+
+            # Hold every range after the first until the reader is closed
+            body_read = r.raw.read
+
+            def read(size=-1):
+                if start not in served:
+                    served[start] = 0
+                    reading.release()
+                gate.wait()
+
+                data = body_read(size)
+                served[start] += len(data)
+                return data
+
+            r.raw.read = read
+            return r
+
+        with mock.patch.object(import_rhcos.SESSION, 'get', side_effect=get):
+            r = import_rhcos.ParallelDownload(url='https://mirror.example.com/rhcos.vmdk.gz', length=len(blob), chunk_size=chunk_size, workers=2)
+            r.read(1)
+
+            for _ in range(2):
+                self.assertTrue(reading.acquire(timeout=5))
+
+            r.close()
+            gate.set()
+            r._executor.shutdown(wait=True)
+
+        # Each running fetch stopped after the block it was reading
+        self.assertEqual(len(served), 2)
+        for size in served.values():
+            self.assertLess(size, chunk_size)
+
+
+class OpenDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.image, self.blob = make_image()
+        self.requests = []
+
+    def serve(self, ranges, total=True):
+        self.responses = []
+
+        def get(url, headers=None, **kwargs):
+            headers = headers or {}
+            self.requests.append(headers.get('Range'))
+
+            if not ranges or 'Range' not in headers:
+                r = FakeResponse(self.blob)
+            else:
+                start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+                r = FakeResponse(
+                    self.blob[start:end + 1],
+                    status_code=206,
+                    headers={'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(self.blob) if total else '*')},
+                )
+
+            self.responses.append(r)
+            return r
+
+        return mock.patch.object(import_rhcos.SESSION, 'get', side_effect=get)
+
+    def test_range_requests_download_in_parallel(self):
+        with self.serve(ranges=True):
+            with import_rhcos.open_download('https://mirror.example.com/rhcos.vmdk.gz') as r:
+                self.assertIsInstance(r, import_rhcos.ParallelDownload)
+                self.assertEqual(r.length, len(self.blob))
+                self.assertEqual(r.read(), self.blob)
+
+    def test_full_response_is_streamed(self):
+        with self.serve(ranges=False):
+            with import_rhcos.open_download('https://mirror.example.com/rhcos.vmdk.gz') as r:
+                self.assertIsInstance(r, import_rhcos.ResumableDownload)
+                self.assertEqual(r.length, len(self.blob))
+                self.assertEqual(r.read(), self.blob)
+
+        # The response to the probe is used for the download itself
+        self.assertEqual(self.requests, ['bytes=0-0'])
+
+    def test_undersized_file_is_not_downloaded(self):
+        release = make_release()
+
+        with self.serve(ranges=True):
+            with self.assertRaisesRegex(RuntimeError, 'too small'):
+                with release.open_rhcos():
+                    pass
+
+        # Only the probe went out, none of the ranges
+        self.assertEqual(self.requests, ['bytes=0-0'])
+
+    def test_undersized_file_of_unknown_size_is_not_read(self):
+        release = make_release()
+
+        with self.serve(ranges=True, total=False):
+            with self.assertRaisesRegex(RuntimeError, 'too small'):
+                with release.open_rhcos():
+                    pass
+
+        # The download was opened for its Content-Length but never read
+        self.assertEqual(self.requests, ['bytes=0-0', None])
+        self.assertEqual(self.responses[1].raw._data.tell(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()